@@ -5,17 +5,28 @@
 # demo of MIDI and synthesis. That said, it is a working
 # instrument.
 
+import math, platform, threading, time
 import mido, sounddevice
+import numba
+from numba.core import cgutils
+from llvmlite import ir
 import numpy as np
 import scipy.io.wavfile as wav
 
 # Sample rate in sps. This doesn't need to be fixed: it
 # could be set to the preferred rate of the audio output.
 sample_rate = 48000
-# Blocksize in samples to process. My desktop machine keeps
-# up at this rate, which provides pretty good latency. Slower
-# machines may need larger numbers.
-blocksize = 16
+# Blocksize in samples to process. Blocks are rendered ahead
+# of the audio output in their own thread, so this need only
+# be small enough to keep latency down: 128 samples is under
+# 3 ms at 48000 sps.
+blocksize = 128
+# Most blocks ever rendered ahead of the audio output. More
+# blocks ride out longer hiccups in the render thread at the
+# cost of more latency. The number actually rendered ahead
+# is set once the audio output is opened, from the size of
+# its own buffer: see below.
+max_prerender_blocks = 8
 
 # XXX Right now the name of the MIDI controller (keyboard)
 # is hard-coded.  This should be fixed somehow. You can use
@@ -26,18 +37,56 @@ blocksize = 16
 # keyboard = mido.open_input('fmlite', virtual=True)
 keyboard = mido.open_input('USB Oxygen 8 v2 MIDI 1')
 
-# Dictionary of currently playing notes, indexed by MIDI key
-# number.
-out_keys = dict()
+# Pool of voices, each of which can play one note. The
+# voice state is kept as a set of parallel arrays indexed by
+# voice number, so that the renderer can run through all the
+# voices in one pass without touching Python objects.
+MAX_VOICES = 32
+# Voice is playing a note.
+voice_active = np.zeros(MAX_VOICES, dtype=np.bool_)
+# Index of the note's oscillator.
+voice_osc = np.zeros(MAX_VOICES, dtype=np.int32)
+# Wavetable step of the note, in table samples per second,
+# computed once at note-on.
+voice_wave_step = np.zeros(MAX_VOICES, dtype=np.float32)
+# Gain of the note from its key velocity.
+voice_velocity = np.zeros(MAX_VOICES, dtype=np.float32)
+# Phase and per-sample phase increment of the note.
+voice_phase = np.zeros(MAX_VOICES, dtype=np.uint32)
+voice_inc = np.zeros(MAX_VOICES, dtype=np.uint32)
+# Attack and release time remaining, in seconds.
+voice_attack = np.zeros(MAX_VOICES, dtype=np.float32)
+voice_release = np.zeros(MAX_VOICES, dtype=np.float32)
+# Note has been released.
+voice_released = np.zeros(MAX_VOICES, dtype=np.bool_)
+
+# Voice playing the note for each MIDI key while the key is
+# held down, or -1.
+key_voice = np.full(128, -1, dtype=np.int32)
 
 # Set true to get a printed log message every time a key is
 # pressed or released. Usually more annoying that useful.
 log_notes = False
 
+# Frequency for each MIDI key number in a 12-tone
+# equal-tempered Western scale, precomputed so that no
+# exponentiation is needed when a note is played. Change 440
+# to 432 for better sound </s>.
+KEY_FREQ = (
+    440.0 * 2.0 ** ((np.arange(128, dtype=np.float64) - 69) / 12)
+).astype(np.float32)
+
+# Gain for each MIDI key velocity, precomputed so that no
+# division is needed when a note is played.
+VEL_TBL = (np.arange(128) / 127.0).astype(np.float32)
+
 # Attack time in seconds.
 attack_time = 0.020
 # Release time in seconds.
 release_time = 0.1
+# Gain below which a released note can't be heard (-80 dB),
+# so it is ended rather than rendered.
+silent_gain = 1e-4
 
 # This count of the number of samples output so far is
 # used to make sure that waveforms are generated with
@@ -47,20 +96,140 @@ release_time = 0.1
 # with static initialization. It does not.
 sample_clock = 0
 
-# Return a sine wave at frequency f over the given sample
-# times t.
-def sine_samples(t, f):
-    return np.sin(2 * np.pi * f * t)
-
-# Return a rising sawtooth wave at frequency f over the
-# given sample times t.
-def saw_samples(t, f):
-    return (f * t) % 2.0 - 1.0
-
-# Return a square wave at frequency f over the
-# given sample times t.
-def square_samples(t, f):
-    return np.sign((f * t) % 2.0 - 1.0)
+# Compile a function to native code, so that sound is
+# generated without going through the interpreter. The
+# compiled code is cached on disk, so only the first run
+# pays for compiling, and it lets go of the interpreter lock
+# while it runs, so that the render thread doesn't hold up
+# the rest of the program or get held up by it while mixing.
+# Note that globals used by a compiled function, such as
+# sample_rate, are frozen in as constants.
+jit_options = dict(
+    cache=True,
+    fastmath=True,
+    boundscheck=False,
+    nogil=True,
+)
+jit = numba.njit(**jit_options)
+
+# Arithmetic on denormal (tiny) floats can be many times
+# slower than normal arithmetic on x86, which could make
+# rendering a quiet tail of a note suddenly expensive. Set
+# the flush-to-zero and denormals-are-zero bits of the
+# calling thread's MXCSR register so that denormals are
+# treated as zero instead.
+if platform.machine() in ('x86_64', 'AMD64', 'i386', 'i686'):
+    @numba.extending.intrinsic
+    def set_mxcsr_ftz_daz(typingctx):
+        def codegen(context, builder, signature, args):
+            i32 = ir.IntType(32)
+            csr = cgutils.alloca_once(builder, i32)
+            # LLVM declares both intrinsics as taking an i8
+            # pointer, which matters when pointers are typed.
+            csr_ptr = builder.bitcast(csr, cgutils.voidptr_t)
+            fnty = ir.FunctionType(ir.VoidType(), [cgutils.voidptr_t])
+            module = builder.module
+            stmxcsr = cgutils.get_or_insert_function(
+                module, fnty, "llvm.x86.sse.stmxcsr",
+            )
+            ldmxcsr = cgutils.get_or_insert_function(
+                module, fnty, "llvm.x86.sse.ldmxcsr",
+            )
+            builder.call(stmxcsr, [csr_ptr])
+            # FTZ is bit 15 and DAZ is bit 6.
+            builder.store(builder.or_(builder.load(csr), i32(0x8040)), csr)
+            builder.call(ldmxcsr, [csr_ptr])
+            return context.get_dummy_value()
+        return numba.types.void(), codegen
+
+    @jit
+    def flush_denormals_to_zero():
+        set_mxcsr_ftz_daz()
+else:
+    def flush_denormals_to_zero():
+        pass
+
+# Phases are kept as 32-bit unsigned integers, with 2**32
+# being one full period of the waveform, so that they wrap
+# around exactly and never lose precision.
+
+# One period of a sine wave, indexed by the top bits of a
+# phase.
+SINE_TBL = np.sin(2 * np.pi * np.arange(1024) / 1024).astype(np.float32)
+
+# Sample times within a block, relative to its start.
+T_REL = np.arange(blocksize, dtype=np.float32) / np.float32(sample_rate)
+# Linear ramp from 0 to 1 over a block, scaled to make each
+# block's envelope.
+RAMP01 = np.linspace(0, 1, blocksize, dtype=np.float32)
+
+# Return the phase increment per sample for frequency f.
+def freq_to_inc(f):
+    return round(f / sample_rate * 2**32) & 0xFFFFFFFF
+
+# The oscillators below each return a single sample, given
+# either the phase or the wavetable step and sample time t.
+
+# Return a sine wave sample at the given phase, looked up in
+# the sine wavetable with linear interpolation.
+@jit
+def sine_sample(phase):
+    i0 = phase >> 22
+    i1 = (i0 + 1) & 1023
+    # The 16 bits below the table index give the fraction
+    # of the way to the next table entry.
+    frac = np.float32((phase >> 6) & 0xFFFF) * np.float32(1 / 65536)
+    return SINE_TBL[i0] + (SINE_TBL[i1] - SINE_TBL[i0]) * frac
+
+# The sawtooth and square waves jump instantly at their
+# edges, which puts harmonics above half the sample rate
+# that alias back down as audible junk. PolyBLEP smooths
+# each jump over the samples on either side of it, which
+# removes most of the aliasing cheaply.
+#
+# Return the polyBLEP correction for a jump of -2 at phase
+# 0, at fractional phase t01 for phase step dt per sample.
+@jit
+def poly_blep(t01, dt):
+    one = np.float32(1)
+    # Both corrections are computed and each is masked by
+    # whether the phase is near its side of the jump, rather
+    # than picked by branching, so that loops calling this
+    # stay free of branches and can still be vectorized.
+    x0 = t01 / dt
+    x1 = (t01 - one) / dt
+    after = np.float32(t01 < dt)
+    before = np.float32(t01 > one - dt)
+    after_jump = x0 + x0 - x0 * x0 - one
+    before_jump = x1 * x1 + x1 + x1 + one
+    return after * after_jump + before * before_jump
+
+# Return the fractional phase, 0..1, of a phase.
+@jit
+def phase_fraction(phase):
+    return np.float32(phase) * np.float32(1 / 2**32)
+
+# Return a rising sawtooth wave sample at the given phase,
+# with phase step dt per sample as a fraction of a period.
+# The phase read as a signed 32-bit integer is already a
+# sawtooth, so it just needs scaling to -1..1. Its jump is
+# halfway through the period.
+@jit
+def saw_sample(phase, dt):
+    signed_phase = (phase ^ 0x80000000) - 0x80000000
+    saw = np.float32(signed_phase) * np.float32(1 / 2**31)
+    return saw - poly_blep(phase_fraction(phase ^ 0x80000000), dt)
+
+# Return a square wave sample at the given phase, with phase
+# step dt per sample as a fraction of a period: 1 for the
+# first half of the period and -1 for the second, from the
+# top bit of the phase.
+@jit
+def square_sample(phase, dt):
+    square = np.float32(1 - 2 * (phase >> 31))
+    square += poly_blep(phase_fraction(phase), dt)
+    square -= poly_blep(phase_fraction(phase ^ 0x80000000), dt)
+    return square
 
 # Generate an array of frame_count sample times
 # starting at sample_clock.
@@ -72,201 +241,455 @@ def sample_times(frame_count):
         dtype=np.float32,
     )
 
-wavetable = np.array(sine_samples(sample_times(640), 750.0))
-nwavetable = len(wavetable)
 wavetable_freq = 750.0
-
-def wave_samples(t, f):
-    step = f / wavetable_freq
-    t0 = (step * t * sample_rate) % nwavetable
-    int_part = np.floor(t0)
-    frac_part = t0 - int_part
-    i0 = int_part.astype(int)
-    i1 = (i0 + 1) % nwavetable
-    x0 = wavetable[i0]
-    x1 = wavetable[i1]
-    return x0 * frac_part + x1 * (1.0 - frac_part)
+wavetable = np.sin(2 * np.pi * wavetable_freq * sample_times(640))
+nwavetable = len(wavetable)
+# The wavetable with its first sample repeated at the end,
+# so that interpolating past the last sample needs no
+# wraparound.
+wavetable_wrap = np.append(wavetable, wavetable[0]).astype(np.float32)
+
+# Return the wavetable step per second for frequency f.
+def freq_to_wave_step(f):
+    return f * sample_rate / wavetable_freq
+
+# Return a sample at sample time t from the wavetable, given
+# the note's wavetable step, with linear interpolation. The
+# table position is wrapped with a floor rather than %, and
+# clamped rather than wrapped again, so that loops calling
+# this have no branches and can be vectorized.
+@jit
+def wave_sample(t, step):
+    n = np.float32(nwavetable)
+    t0 = step * t
+    t0 -= np.floor(t0 * np.float32(1 / nwavetable)) * n
+    # Rounding can leave t0 just outside the table: truncating
+    # takes a tiny negative t0 to 0, and the top end is
+    # clamped.
+    i0 = min(int(t0), nwavetable - 1)
+    frac = t0 - np.float32(i0)
+    x0 = wavetable_wrap[i0]
+    return x0 + (wavetable_wrap[i0 + 1] - x0) * frac
 
 test_wavetable = False
 if test_wavetable:
     test_wave = np.zeros(1, dtype=np.float32)
+    step = np.float32(freq_to_wave_step(750.0))
     for _ in range(int(sample_rate / blocksize)):
         t = sample_times(blocksize)
-        test_wave = np.append(test_wave, wave_samples(t, 750))
+        block = [wave_sample(x, step) for x in t]
+        test_wave = np.append(test_wave, np.float32(block))
         sample_clock += blocksize
     wav.write("test.wav", sample_rate, test_wave)
     exit(0)
 
-# Oscillators.
-oscillators = [
-    sine_samples,
-    saw_samples,
-    square_samples,
-    wave_samples,
-]
+# Number of oscillators. They are numbered by out_osc in
+# the order that render_note() picks them: 0 sine, 1
+# sawtooth, 2 square, 3 wavetable. An oscillator added here
+# must be added there too.
+n_oscillators = 4
 
 # Index of current oscillator.
 out_osc = 0
 
-# Representation of a note currently being played.
-class Note:
-    def __init__(self, key, osc):
-        self.frequency = key_to_freq(key)
-        self.attack_time_remaining = attack_time
-        self.out_osc = osc
-        self.playing = True
-        self.release_time_remaining = None
-
-    # Note has been released.
-    def release(self):
-        self.release_time_remaining = release_time
-
-    # Accept a time linspace to generate samples in.  Return
-    # that many samples of note being played, or None if
-    # note is over.
-    def samples(self, t):
-        if not self.playing:
-            return None
-
-        frame_count = len(t)
-        out_frequency = self.frequency
-
-        # Pick and generate a waveform.
-        samples = oscillators[self.out_osc](t, out_frequency)
-
-        if self.release_time_remaining is not None:
-            # Do release part of ADSR envelope.
-            release_time_remaining = self.release_time_remaining
-            if release_time_remaining <= 0:
-                self.playing = False
-                return None
-            # Figure out the gain at the starting time according
-            # to a linear ramp.
-            start_gain = release_time_remaining / release_time
-            # Figure out the time after the last sample, and
-            # adjust the release_time_remaining to reflect it.
-            end_time = frame_count / sample_rate
-            release_time_remaining -= end_time
-            # Figure out the gain at the ending time according
-            # to a linear ramp.
-            end_gain = release_time_remaining / release_time
-            # Calculate the linear slope over the samples. Make
-            # sure it doesn't go below 0.0 due to finishing the
-            # release in the middle.
-            #
-            # XXX This should probably be linear in dBFS rather than
-            # linear in amplitude, but meh.
-            envelope = np.clip(
-                np.linspace(start_gain, end_gain, frame_count),
-                0.0,
-                1.0,
-            )
-            # Apply the per-sample gains for the release.
-            samples *= envelope
-            # Update the release time remaining for next pass.
-            self.release_time_remaining = max(0, release_time_remaining)
-        elif self.attack_time_remaining > 0.0:
-            # Do attack part of ADSR envelope.
-            attack_time_remaining = self.attack_time_remaining
-            # Figure out the gain at the starting time according
-            # to a linear ramp.
-            start_gain = 1.0 - attack_time_remaining / attack_time
-            # Figure out the time after the last sample, and
-            # adjust the attack_time_remaining to reflect it.
-            end_time = frame_count / sample_rate
-            attack_time_remaining -= end_time
-            # Figure out the gain at the ending time according
-            # to a linear ramp.
-            end_gain = 1.0 - attack_time_remaining / attack_time
-            # Calculate the linear slope over the samples. Make
-            # sure it doesn't go above 1.0 due to finishing the
-            # attack in the middle.
-            #
-            # XXX This should probably be linear in dBFS rather than
-            # linear in amplitude, but meh.
-            envelope = np.clip(
-                np.linspace(start_gain, end_gain, frame_count),
-                0.0,
-                1.0,
-            )
-            # Apply the per-sample gains for the attack.
-            samples *= envelope
-            # Update the attack time remaining for next pass.
-            self.attack_time_remaining = attack_time_remaining
+# Sample times for the block being rendered.
+t_scratch = np.zeros(blocksize, dtype=np.float32)
+
+# Return the envelope gain for sample i of a block, on a
+# linear ramp starting at gain_start and changing by
+# gain_change over the block, clipped to 0..gain_max if
+# clip is set.
+@jit
+def ramp_gain(i, gain_start, gain_change, clip, gain_max):
+    gain = gain_start + gain_change * RAMP01[i]
+    if clip:
+        gain = min(max(gain, np.float32(0)), gain_max)
+    return gain
+
+# Mix a block of samples of a note at sample times t into
+# out, applying the note's envelope scaled by gain. The
+# scaling is folded into the envelope so that the mix comes
+# out at its final level without another pass over out. The
+# note's state is passed in, and its new state is returned
+# as a tuple (phase, attack_time_remaining,
+# release_time_remaining, playing). The phase is handled as
+# a 64-bit integer here, masked back to 32 bits.
+@jit
+def render_note(
+    out,
+    t,
+    gain,
+    osc,
+    wave_step,
+    phase,
+    inc,
+    attack_time_remaining,
+    release_time_remaining,
+    released,
+):
+    frame_count = len(out)
+    # Figure out the time after the last sample.
+    end_time = frame_count / sample_rate
+
+    if released:
+        # Do release part of ADSR envelope. Figure out the gains
+        # at the starting and ending times according to a
+        # linear ramp.
+        start_gain = release_time_remaining / release_time
+        # The gain only falls during the release, so once the
+        # starting gain is inaudible the note is over: end it
+        # before generating any samples.
+        if start_gain * gain <= silent_gain:
+            return phase, attack_time_remaining, release_time_remaining, False
+        release_time_remaining -= end_time
+        end_gain = release_time_remaining / release_time
+        release_time_remaining = max(0.0, release_time_remaining)
+    elif attack_time_remaining > 0.0:
+        # Do attack part of ADSR envelope.
+        start_gain = 1.0 - attack_time_remaining / attack_time
+        attack_time_remaining -= end_time
+        end_gain = 1.0 - attack_time_remaining / attack_time
+    else:
+        start_gain = 1.0
+        end_gain = 1.0
+
+    # Ramp the gain linearly over the samples. The gain must
+    # be clipped to 0..1 if the attack or release finishes in
+    # the middle of the block, but usually it stays in range
+    # and the clipping can be skipped. The per-sample work is
+    # all done in float32.
+    #
+    # XXX This should probably be linear in dBFS rather than
+    # linear in amplitude, but meh.
+    clip = not (0.0 <= start_gain <= 1.0 and 0.0 <= end_gain <= 1.0)
+    gain_start = np.float32(start_gain * gain)
+    gain_change = np.float32((end_gain - start_gain) * gain)
+    # Phase step per sample as a fraction of a period.
+    dt = phase_fraction(inc)
+
+    # Pick and generate a waveform. Each oscillator gets its
+    # own loop, and each sample's phase is computed directly
+    # from its index rather than carried over from the
+    # previous sample, so that the loops have no branches or
+    # dependencies between samples. This lets the compiler
+    # turn them into SIMD code, with gathers for the table
+    # lookups. The oscillators are numbered as described at
+    # n_oscillators, which must be kept in step with this.
+    if osc == 0:
+        for i in range(frame_count):
+            x = sine_sample((phase + inc * i) & 0xFFFFFFFF)
+            out[i] += ramp_gain(i, gain_start, gain_change, clip, gain) * x
+    elif osc == 1:
+        for i in range(frame_count):
+            x = saw_sample((phase + inc * i) & 0xFFFFFFFF, dt)
+            out[i] += ramp_gain(i, gain_start, gain_change, clip, gain) * x
+    elif osc == 2:
+        for i in range(frame_count):
+            x = square_sample((phase + inc * i) & 0xFFFFFFFF, dt)
+            out[i] += ramp_gain(i, gain_start, gain_change, clip, gain) * x
+    else:
+        for i in range(frame_count):
+            x = wave_sample(t[i], wave_step)
+            out[i] += ramp_gain(i, gain_start, gain_change, clip, gain) * x
+    phase = (phase + inc * frame_count) & 0xFFFFFFFF
+
+    return phase, attack_time_remaining, release_time_remaining, True
 
-        return samples
+# Mix len(out) samples of all the active voices at sample
+# times t into out, each scaled by gain and by its velocity,
+# updating the voice state. Voices whose notes are over are
+# made inactive.
+#
+# The mixer is compiled up front for contiguous arrays of
+# the voice state types, rather than on first call, so that
+# the compiler can rely on unit-stride access when
+# vectorizing. Passing an array that is not contiguous, or
+# not of the expected type, is an error rather than a silent
+# recompile for the slower general case.
+@numba.njit(
+    numba.void(
+        numba.float32[::1],
+        numba.float32[::1],
+        numba.float32,
+        numba.boolean[::1],
+        numba.int32[::1],
+        numba.float32[::1],
+        numba.float32[::1],
+        numba.uint32[::1],
+        numba.uint32[::1],
+        numba.float32[::1],
+        numba.float32[::1],
+        numba.boolean[::1],
+    ),
+    **jit_options,
+)
+def mix_voices(
+    out,
+    t,
+    gain,
+    active,
+    osc,
+    wave_step,
+    velocity,
+    phase,
+    inc,
+    attack,
+    release,
+    released,
+):
+    for v in range(len(active)):
+        if not active[v]:
+            continue
+        (
+            phase[v],
+            attack[v],
+            release[v],
+            active[v],
+        ) = render_note(
+            out,
+            t,
+            gain * velocity[v],
+            osc[v],
+            wave_step[v],
+            np.int64(phase[v]),
+            np.int64(inc[v]),
+            attack[v],
+            release[v],
+            released[v],
+        )
+
+# The voice state arrays, in the order taken by mix_voices().
+voices = (
+    voice_active,
+    voice_osc,
+    voice_wave_step,
+    voice_velocity,
+    voice_phase,
+    voice_inc,
+    voice_attack,
+    voice_release,
+    voice_released,
+)
 
-# This callback is called by `sounddevice` to get some
-# samples to output. It's the heart of sound generation in
-# the synth.
-def output_callback(out_data, frame_count, time_info, status):
+# Start playing a note with the given velocity gain on a
+# voice taken from the list free_voices, which is refilled
+# from the voice pool when it runs out. If the key is
+# already sounding its old voice is released first, so that
+# the old note dies away while the new one starts.
+def note_on(key, osc, velocity, free_voices):
+    note_off(key)
+    # The list is filled in reverse order, so that voices
+    # come off its end lowest first. Filling it with a plain
+    # loop rather than array operations keeps it from
+    # building temporary arrays.
+    if not free_voices:
+        for v in range(MAX_VOICES - 1, -1, -1):
+            if not voice_active[v]:
+                free_voices.append(v)
+    # If every voice is busy the note is dropped.
+    if not free_voices:
+        return
+    v = free_voices.pop()
+    key_voice[key] = v
+    voice_osc[v] = osc
+    freq = key_to_freq(key)
+    voice_wave_step[v] = freq_to_wave_step(freq)
+    voice_velocity[v] = velocity
+    voice_phase[v] = 0
+    voice_inc[v] = freq_to_inc(freq)
+    voice_attack[v] = attack_time
+    voice_release[v] = release_time
+    voice_released[v] = False
+    # Make the voice active last, so that the render thread
+    # never sees a half-started voice.
+    voice_active[v] = True
+
+# Release the voice playing the note for a key, if any.
+def note_off(key):
+    v = key_voice[key]
+    if v < 0:
+        return
+    key_voice[key] = -1
+    voice_release[v] = release_time
+    voice_released[v] = True
+
+# Fill the samples array with the next block of sound. It's
+# the heart of sound generation in the synth.
+#
+# The underscored arguments are never passed: their defaults
+# bind globals used on every block to local names, which
+# are quicker to look up.
+def render_block(
+    samples,
+    _add=np.add,
+    _count_nonzero=np.count_nonzero,
+    _float32=np.float32,
+    _mix_voices=mix_voices,
+    _voices=voices,
+    _voice_active=voice_active,
+    _t_rel=T_REL,
+    _t_scratch=t_scratch,
+    _sample_rate=sample_rate,
+):
     # Make sure to update the *global* sample clock.
     global sample_clock
 
-    # A non-None status indicates that something has
-    # happened with sound output that shouldn't have.  This
-    # is almost always an underrun due to generating samples
-    # too slowly.
-    if status:
-        print("output callback:", status)
+    frame_count = len(samples)
 
     # Start with silence and maybe work up.
-    samples = np.zeros(frame_count, dtype=np.float32)
+    samples.fill(0.0)
 
     # If keys are pressed, generate sounds.
-    if out_keys:
+    if _voice_active.any():
         # Time point in seconds for each sample.
-        t = sample_times(frame_count)
-
-        # Set of keys that need playing.
-        on_keys = list(out_keys.keys())
-        # Set of keys that need deleting.
-        del_keys = set()
-        # Generate the samples for each key and add them
-        # into the mix.
-        for key in on_keys:
-            note = out_keys[key]
-            note_samples = note.samples(t)
-            if note_samples is None:
-                del_keys.add(key)
-                continue
-            samples += note_samples
-
-        # Close the deleted keys.
-        for key in del_keys:
-            del out_keys[key]
-
-    # Adjust the gain so that each key gets louder up to
-    # some maximum.  If necessary, scale to avoid clipping.
-    nkeys = len(out_keys)
-    if nkeys <= 8:
-        samples *= 1.0 / 8.0
-    else:
-        samples *= 1.0 / len(out_keys)
+        t = _t_scratch
+        _add(_t_rel, sample_clock / _sample_rate, out=t)
+
+        # Adjust the gain so that each key gets louder up to
+        # some maximum.  If necessary, scale to avoid
+        # clipping.
+        nkeys = _count_nonzero(_voice_active)
+        gain = _float32(1.0 / max(8, nkeys))
 
-    # Reshape to have an array of 1 sample for each frame.
-    # Must write into the existing array rather than
-    # accidentally copying over the parameter.
-    out_data[:] = np.reshape(samples, (frame_count, 1))
+        # Mix the voices into the block.
+        _mix_voices(samples, t, gain, *_voices)
 
     # Bump the sample clock for next cycle.
     sample_clock += frame_count
 
-# Calculate frequency for a 12-tone equal-tempered Western
-# scale given MIDI note number. Change 440 to 432 for better
-# sound </s>.
+# Ring of blocks rendered ahead of the audio output. The
+# ring lives in a single buffer, so that the native output
+# callback can reach all of it through one pointer: a header
+# of counters, followed by the blocks themselves.
+RING_HEADER_BYTES = 64
+RING_BYTES = RING_HEADER_BYTES + max_prerender_blocks * blocksize * 4
+ring_state = np.zeros(RING_BYTES, dtype=np.uint8)
+# The counters in the header, by index: blocks read by the
+# output callback, blocks written by the render thread,
+# number of output callbacks with a bad status, the last bad
+# status, and the number of blocks of the ring in use. The
+# render thread is the only writer of the count of blocks
+# written and the output callback the only writer of the
+# count of blocks read and the statuses, so the ring needs
+# no locking. The number of blocks in use is set before
+# either starts.
+(
+    RING_READ,
+    RING_WRITTEN,
+    RING_STATUS_COUNT,
+    RING_STATUS,
+    RING_DEPTH,
+) = range(5)
+ring_counters = ring_state[:RING_HEADER_BYTES].view(np.int64)
+ring = ring_state[RING_HEADER_BYTES:].view(np.float32)
+ring = ring.reshape(max_prerender_blocks, blocksize)
+# The blocks of the ring, sliced out once up front.
+ring_blocks = tuple(ring)
+
+# Keep the ring full of rendered blocks. Runs forever in the
+# render thread.
+def render_loop():
+    # Rendering happens on this thread, so this is where
+    # denormals need to be turned off.
+    flush_denormals_to_zero()
+
+    # Local names for the globals used on every pass.
+    sleep = time.sleep
+    render = render_block
+    blocks = ring_blocks
+    counters = ring_counters
+    nblocks = counters[RING_DEPTH]
+
+    block_time = blocksize / sample_rate
+    written = 0
+    while True:
+        # Wait for the audio output to free up a block.
+        if written - counters[RING_READ] >= nblocks:
+            sleep(block_time / 2)
+            continue
+        render(blocks[written % nblocks])
+        written += 1
+        counters[RING_WRITTEN] = written
+
+# This callback is called by PortAudio to get some samples
+# to output. It just copies out the next prerendered block.
+# It is compiled to a native C callback, so the audio thread
+# never runs the Python interpreter or waits for the GIL. The
+# callback gets the ring through its user data pointer:
+# globals are frozen into compiled code, so it cannot see
+# the ring's counters change through them.
+@numba.cfunc(
+    numba.int32(
+        numba.types.voidptr,
+        numba.types.CPointer(numba.float32),
+        numba.types.ulong,
+        numba.types.voidptr,
+        numba.types.ulong,
+        numba.types.CPointer(numba.uint8),
+    ),
+    cache=True,
+)
+def output_callback(
+    in_data,
+    out_data,
+    frame_count,
+    time_info,
+    status,
+    user_data,
+):
+    state = numba.carray(user_data, RING_BYTES)
+    counters = state[:RING_HEADER_BYTES].view(np.int64)
+    blocks = state[RING_HEADER_BYTES:].view(np.float32)
+    out = numba.carray(out_data, frame_count)
+
+    # A nonzero status indicates that something has
+    # happened with sound output that shouldn't have.  This
+    # is almost always an underrun due to generating samples
+    # too slowly. The callback can't print, so it leaves the
+    # status for the main thread to report.
+    if status:
+        counters[RING_STATUS] = status
+        counters[RING_STATUS_COUNT] += 1
+
+    # If the render thread has fallen behind, there is
+    # nothing to do but play silence.
+    read = counters[RING_READ]
+    if read == counters[RING_WRITTEN] or frame_count != blocksize:
+        out[:] = 0.0
+        return 0
+
+    start = (read % counters[RING_DEPTH]) * blocksize
+    out[:] = blocks[start:start + blocksize]
+    counters[RING_READ] = read + 1
+    # Tell PortAudio to keep going.
+    return 0
+
+# Number of bad output statuses reported so far.
+output_statuses_reported = 0
+
+# Print any bad status the output callback has seen since
+# the last call.
+def report_output_status():
+    global output_statuses_reported
+
+    count = ring_counters[RING_STATUS_COUNT]
+    if count != output_statuses_reported:
+        status = sounddevice.CallbackFlags(int(ring_counters[RING_STATUS]))
+        print("output callback:", status)
+        output_statuses_reported = count
+
+# Look up frequency for a 12-tone equal-tempered Western
+# scale given MIDI note number.
 def key_to_freq(key):
-    return 440 * 2 ** ((key - 69) / 12)
+    return KEY_FREQ[key]
 
-# Block waiting for the instrument (keyboard) to send a MIDI
-# message, then handle it. Return False if the MIDI message
-# wants the synthesizer to stop, True otherwise.
-def process_midi_event():
+# Handle a MIDI message from the instrument (keyboard),
+# starting notes on voices from free_voices. Return False if
+# the MIDI message wants the synthesizer to stop, True
+# otherwise.
+def process_midi_event(mesg, free_voices):
     # These globals define the interface to sound generation.
-    global out_keys, out_osc
-
-    # Block until a MIDI message is received.
-    mesg = keyboard.receive()
+    global out_osc
 
     # Select what to do based on message type.
     mesg_type = mesg.type
@@ -275,22 +698,21 @@ def process_midi_event():
     if mesg_type == 'note_on' and mesg.velocity == 0:
         mesg_type = 'note_off'
     # Add a note to the sound. If it is already on just
-    # start it again.
+    # start it again on a new voice.
     if mesg_type == 'note_on':
         key = mesg.note
-        velocity = mesg.velocity / 127
+        velocity = VEL_TBL[mesg.velocity]
         if log_notes:
-            print('note on', key, mesg.velocity, round(velocity, 2))
-        out_keys[key] = Note(key, out_osc)
+            print('note on', key, mesg.velocity, round(float(velocity), 2))
+        note_on(key, out_osc, velocity, free_voices)
     # Remove a note from the sound. If it is already off,
     # this message will be ignored.
     elif mesg_type == 'note_off':
         key = mesg.note
-        velocity = round(mesg.velocity / 127, 2)
         if log_notes:
-            print('note off', key, mesg.velocity, velocity)
-        if key in out_keys:
-            out_keys[key].release()
+            velocity = VEL_TBL[mesg.velocity]
+            print('note off', key, mesg.velocity, round(float(velocity), 2))
+        note_off(key)
     # Handle various controls.
     elif mesg.type == 'control_change':
         # XXX Hard-wired for "stop" key on Oxygen8.
@@ -303,12 +725,10 @@ def process_midi_event():
         # keys on Oxygen8.
         elif mesg.control == 21:
             print('program change -')
-            n_osc = len(oscillators)
-            out_osc = (out_osc + n_osc - 1) % n_osc
+            out_osc = (out_osc + n_oscillators - 1) % n_oscillators
         elif mesg.control == 22:
             print('program change +')
-            n_osc = len(oscillators)
-            out_osc = (out_osc + 1) % n_osc
+            out_osc = (out_osc + 1) % n_oscillators
         # Unknown control changes are logged and ignored.
         else:
             print(f"control", mesg.control, mesg.value)
@@ -320,16 +740,60 @@ def process_midi_event():
         print('unknown MIDI message', mesg)
     return True
 
+# Free voices for the batch of MIDI messages being handled,
+# kept from batch to batch so that it is not reallocated.
+free_voices = []
+
+# Handle all the MIDI messages that have arrived since the
+# last call, without blocking. Messages that arrive together,
+# such as the notes of a chord, are handled in one batch
+# that shares a single search for free voices. Return False
+# if a MIDI message wants the synthesizer to stop, True
+# otherwise.
+def process_midi_events():
+    free_voices.clear()
+    for mesg in keyboard.iter_pending():
+        if not process_midi_event(mesg, free_voices):
+            return False
+    return True
 
-# Start audio playing. Must keep up with output from here on.
-output_stream = sounddevice.OutputStream(
+
+# Open the audio output. `sounddevice`'s low-level stream
+# class is used so that PortAudio can be handed the native
+# output callback and the ring pointer directly. The output
+# is asked for low latency: with the default high latency
+# PortAudio keeps a big host buffer, and fills it by calling
+# the output callback for several blocks in a row.
+output_stream = sounddevice._StreamBase(
+    kind='output',
     samplerate=sample_rate,
     channels=1,
+    dtype='float32',
     blocksize=blocksize,
-    callback=output_callback,
+    latency='low',
+    callback=output_callback.address,
+    userdata=sounddevice._ffi.cast('void *', ring_state.ctypes.data),
 )
+
+# Render as many blocks ahead as the host buffer can ask for
+# in one go, so that the ring isn't emptied when it does,
+# but no more: every block in the ring adds to the latency
+# of every note. At least two blocks are needed so that one
+# can be rendered while the other is played.
+host_blocks = math.ceil(output_stream.latency * sample_rate / blocksize)
+prerender_blocks = min(max(2, host_blocks), max_prerender_blocks)
+ring_counters[RING_DEPTH] = prerender_blocks
+
+# Start rendering audio ahead of output.
+render_thread = threading.Thread(target=render_loop, daemon=True)
+render_thread.start()
+
+# Start audio playing. Must keep up with output from here on.
 output_stream.start()
 
-# Run the synthesizer until its stop key is pressed.
-while process_midi_event():
-    pass
+# Run the synthesizer until its stop key is pressed,
+# checking for MIDI messages and output trouble every
+# millisecond.
+while process_midi_events():
+    report_output_status()
+    time.sleep(0.001)